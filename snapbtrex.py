@@ -134,17 +134,36 @@ Contents:
 
 """
 
+import argparse
+import calendar
+import contextlib
+import functools
+import heapq
 import itertools
 import math
 import os
 import os.path
+import re
+import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
 import time
 
 DATE_FORMAT = "%Y%m%d-%H%M%S"  # date format used for directories to clean
 
 DEFAULT_KEEP_BACKUPS = 10
 
+# snapshots removed by one btrfs call, keeps the command line short
+DELETE_BATCH_SIZE = 64
+
+# --stream-compress: (compress on the sender, decompress on the receiver)
+STREAM_COMPRESSORS = {
+    "zstd": (["zstd", "-q", "-1", "-T0", "-c"], ["zstd", "-q", "-d", "-c"]),
+    "lz4": (["lz4", "-q", "-c"], ["lz4", "-q", "-d", "-c"]),
+}
+
 LOG_LOCAL = "Local  > "
 LOG_REMOTE = "Remote > "
 LOG_EXEC = "EXEC  >-> "
@@ -153,12 +172,14 @@ LOG_OUTPUT = "OUTPUT > "
 
 # find TIME_SCALE: t < 2**32 => e**(t/c) < 2**32
 TIME_SCALE = math.ceil(float((2 ** 32) / math.log(2 ** 32)))
+INV_TIME_SCALE = 1.0 / TIME_SCALE  # multiply instead of divide in timef
 
 
+@functools.lru_cache(maxsize=None)
 def timef(x):
     # make value inverse exponential in the time passed
     try:
-        v = math.exp(_timestamp(x) / TIME_SCALE)
+        v = math.exp(_timestamp(x) * INV_TIME_SCALE)
     except ZeroDivisionError:
         v = None
     return v
@@ -173,96 +194,225 @@ def timestamp(x):
 
 
 def _timestamp(x):
-    return time.mktime(time.strptime(os.path.split(x)[1], DATE_FORMAT))
+    return _parse_timestamp(os.path.split(x)[1])
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_timestamp(name):
+    # snapshot names are parsed over and over during cleanup, keyed by basename
+    # fast path for DATE_FORMAT "YYYYmmdd-HHMMSS" without strptime, the names
+    # are generated in GMT (see datestamp) so they are converted as such
+    if not (len(name) == 15 and name[8] == "-" and (name[:8] + name[9:]).isdigit()):
+        raise ValueError(f"time data {name!r} does not match format {DATE_FORMAT!r}")
+    fields = (
+        int(name[0:4]),
+        int(name[4:6]),
+        int(name[6:8]),
+        int(name[9:11]),
+        int(name[11:13]),
+        int(name[13:15]),
+    )
+    t = calendar.timegm(fields + (0, 0, 0))
+    # timegm happily normalizes e.g. a 13th month, reject those
+    if time.gmtime(t)[:6] != fields:
+        raise ValueError(f"time data {name!r} is not a valid date")
+    return t
 
 
 def sorted_age(dirs, max_age):
-    for xv, x in sorted((timestamp(y), y) for y in dirs):
-        if xv < max_age:
-            yield x
+    # oldest first, lazily from a heap as mostly only the first one is taken
+    heap = [(timestamp(y), y) for y in dirs]
+    heapq.heapify(heap)
+    while heap:
+        xv, x = heapq.heappop(heap)
+        if xv >= max_age:
+            break  # all the others are younger
+        yield x
 
 
 def first(it):
-    for x in it:
-        return x
+    return next(iter(it), None)
 
 
-def sorted_value(dirs):
-    if len(dirs) <= 0:
-        return dirs
-    else:
-        return _sorted_value(dirs)
+def batches(items, size):
+    # Yield items[0:size], items[size:2*size], ...
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
 
 
-def _sorted_value(dirs):
+def sorted_value(dirs):
     # Iterate dirs, sorted by their relative value when deleted
-    def poles(items):
-        # Yield (items[0], items[1]), (items[1], items[2]), ... (items[n-1], items[n])
-        rest = iter(items)
-        last = next(rest)
-        for n in rest:
-            yield last, n
-            last = n
-
-    def all_but_last(items):
-        # Yield items[0], ..., items[n-1]
-        rest = iter(items)
-        last = next(rest)
-        for x in rest:
-            yield last
-            last = x
-
-    # Remaining candidates for yield,
-    # except the "max" one (latest)
-    candidates = dict(
-        all_but_last((x, xf) for xf, x in sorted((timef(y), y) for y in dirs) if xf)
-    )
+    # Remaining candidates for yield ordered by timestamp (as v is monotonic
+    # in timestamp), except the "max" one (latest)
+    remain = sorted((xf, x) for xf, x in ((timef(y), y) for y in dirs) if xf)[:-1]
+    if not remain:
+        return
+    values = {x: xf for xf, x in remain}
+    # Linked list of the remaining candidates, only the newer neighbour of
+    # a pair is ever deleted so a forward link is sufficient
+    newer = {frm: to for (_, frm), (_, to) in zip(remain, remain[1:])}
+    # Find the "amount of information we loose by deleting the
+    # latest of the pair", entries are invalidated lazily
+    diffs = [(values[to] - values[frm], frm, to) for frm, to in newer.items()]
+    heapq.heapify(diffs)
+
     # Keep going as long as there is anything to remove
-    while len(candidates) > 1:
-        # Get candidates ordered by timestamp (as v is monotonic in timestamp)
-        remain = sorted((v, k) for k, v in candidates.items())
-        # Find the "amount of information we loose by deleting the
-        # latest of the pair"
-        diffs = list(
-            (to_tf - frm_tf, frm, to) for ((frm_tf, frm), (to_tf, to)) in poles(remain)
-        )
+    count = len(remain)
+    while count > 1:
         # Select the least important one
-        mdiff, mfrm, mto = min(diffs)
-
-        del candidates[mto]  # That's not a candidate any longer, it's gonna go
+        mdiff, mfrm, mto = heapq.heappop(diffs)
+        if newer.get(mfrm) != mto:
+            continue  # stale pair, one of both is already gone
+
+        # That's not a candidate any longer, it's gonna go
+        nxt = newer.pop(mto, None)
+        if nxt is None:
+            del newer[mfrm]
+        else:
+            newer[mfrm] = nxt
+            heapq.heappush(diffs, (values[nxt] - values[mfrm], mfrm, nxt))
+        count -= 1
         yield mto
 
     # also, we must delete the last entry
-    yield next(iter(candidates.keys()))
+    yield remain[0][1]
+
+
+@functools.lru_cache(maxsize=1)
+def _datestamp(secs):
+    # formatted once per second, every trace line asks for the current one
+    return time.strftime(DATE_FORMAT, time.gmtime(secs))
 
 
 class Operations:
     def __init__(self, path, trace=None):
-        self.tracef = trace
+        # tracing to null_trace is no tracing, callers can check tracef
+        self.tracef = None if trace is null_trace else trace
         self.path = path
-
-    def check_call(self, args, shell=False, dry_safe=False):
-        import subprocess
-
-        cmd_str = " ".join(args)
-        self.trace(LOG_EXEC + cmd_str)
-        p = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell
+        # snapshot names are joined to path a lot, do it by concatenation
+        self.path_prefix = os.path.join(path, "")
+        self.ssh_options = []
+        # snapshots in path, read once and then kept up to date by our own
+        # operations, which also simulates them for dry runs
+        self.listing = None
+        # same for the snapshots on remote hosts by (receiver, receiver_path)
+        self.remote_listing = {}
+
+    def check_call(self, args, dry_safe=False, trace_output=True):
+        return self.wait_call(self.async_check_call(args), trace_output)
+
+    def async_check_call(self, args):
+        # start the command, wait_call() collects the result
+        self.trace(LOG_EXEC + " ".join(args))
+        return subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="ignore",
         )
+
+    def wait_call(self, p, trace_output=True):
         stdout, stderr = p.communicate()
 
         if stderr:
-            stderr = stderr.decode(encoding=sys.stderr.encoding, errors="ignore")
-            self.trace(LOG_STDERR + stderr)
+            self.trace(LOG_STDERR + "%s", stderr)
 
-        if stdout:
-            stdout = stdout.decode(encoding=sys.stdout.encoding, errors="ignore")
-            self.trace(LOG_OUTPUT + stdout)
+        if stdout and trace_output:
+            self.trace(LOG_OUTPUT + "%s", stdout)
 
         if p.returncode != 0:
-            raise RuntimeError(f"failed {cmd_str}")
+            msg = f"failed {' '.join(p.args)}"
+            if stderr:
+                msg += f": {stderr.strip()}"
+            raise RuntimeError(msg)
         return stdout  # return the content
 
+    def check_pipe(self, *commands):
+        # Run commands connected by pipes like a shell would, but without one.
+        # The stream stays between the processes, stderr of all of them and
+        # the output of the last one (e.g. btrfs receive -v) go to the trace.
+        cmd_str = " | ".join(" ".join(args) for args in commands)
+        self.trace(LOG_EXEC + cmd_str)
+        err_r, err_w = os.pipe()
+        procs = []
+        try:
+            stdin = None
+            for args in commands:
+                last = len(procs) == len(commands) - 1
+                p = subprocess.Popen(
+                    args,
+                    stdin=stdin,
+                    stdout=err_w if last else subprocess.PIPE,
+                    stderr=err_w,
+                )
+                if stdin is not None:
+                    stdin.close()  # let SIGPIPE reach the writer if the reader dies
+                stdin = p.stdout
+                procs.append(p)
+        except OSError:
+            for p in procs:
+                p.kill()
+                p.wait()
+            raise
+        finally:
+            os.close(err_w)
+
+        # pass the output on as it arrives instead of holding all of it until
+        # the (possibly hours long) send is done, of lines overwritten by
+        # "\r" (pv progress) only the last state is kept like on a terminal
+        with os.fdopen(err_r, "rb") as f:
+            for line in f:
+                line = line.rstrip().rpartition(b"\r")[2]
+                if line:
+                    line = line.decode(sys.stderr.encoding, errors="ignore")
+                    self.trace(LOG_STDERR + "%s", line)
+        returncodes = [p.wait() for p in procs]
+
+        if any(returncodes):
+            raise RuntimeError(f"failed {cmd_str} with {returncodes}")
+
+    def ssh_args(self, receiver, ssh_port):
+        return ["ssh", "-p", ssh_port, *self.ssh_options, receiver]
+
+    @contextlib.contextmanager
+    def ssh_session(self, receiver, ssh_port):
+        # Keep one master connection to the receiver open and multiplex all
+        # ssh calls over it. If the master could not be started the calls
+        # simply connect on their own.
+        ctl_dir = tempfile.mkdtemp(prefix="snapbtrex-")
+        ctl_path = os.path.join(ctl_dir, "ssh")
+        self.trace(LOG_REMOTE + f"open ssh master connection to host={receiver}")
+        # -f: returns once authenticated, the master stays in the background
+        if self.call_quiet(
+            ["ssh", "-p", ssh_port, "-M", "-N", "-f", "-S", ctl_path, receiver]
+        ):
+            self.ssh_options = ["-S", ctl_path]
+        else:
+            self.trace(LOG_REMOTE + "could not open ssh master connection")
+        try:
+            yield
+        finally:
+            if self.ssh_options:
+                self.ssh_options = []
+                self.call_quiet(["ssh", "-S", ctl_path, "-O", "exit", receiver])
+                self.trace(
+                    LOG_REMOTE + f"closed ssh master connection to host={receiver}"
+                )
+            shutil.rmtree(ctl_dir, ignore_errors=True)
+
+    def call_quiet(self, args):
+        # run without any output, the background ssh master must not hold
+        # on to our pipes
+        self.trace(LOG_EXEC + " ".join(args))
+        p = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return p.wait() == 0
+
     def sync(self, dir):
         # syncing to be sure the operation is on the disc
         self.trace(LOG_LOCAL + f"sync filesystem {dir}")
@@ -270,160 +420,281 @@ class Operations:
         self.check_call(args)
         self.trace(LOG_LOCAL + f"done sync filesystem {dir}")
 
-    def unsnap(self, dir):
-        self.unsnapx(os.path.join(self.path, dir))
+    def unsnap_many(self, dirs):
+        self.unsnapx_many([self.path_prefix + dir for dir in dirs])
+        self.forget(dirs)
 
-    def unsnapx(self, dir):
-        self.trace(LOG_LOCAL + f"remove snapshot {dir}")
-        args = ["sudo", "btrfs", "subvolume", "delete", dir]
-        self.check_call(args)
-        self.trace(LOG_LOCAL + f"done remove snapshot {dir}")
+    def forget(self, dirs):
+        if self.listing is not None:
+            # one pass over the listing instead of one per removed snapshot
+            dirs = set(dirs)
+            self.listing[:] = [d for d in self.listing if d not in dirs]
+
+    def unsnapx_many(self, dirs):
+        # one btrfs call and one transaction commit per batch of snapshots
+        for batch in batches(dirs, DELETE_BATCH_SIZE):
+            self.trace(LOG_LOCAL + f"remove snapshots {' '.join(batch)}")
+            args = ["sudo", "btrfs", "subvolume", "delete", "--commit-after", *batch]
+            self.check_call(args)
+            self.trace(LOG_LOCAL + f"done remove {len(batch)} snapshots")
 
     def freespace(self):
         # sync filesystem before assessing the free space
         self.sync(self.path)
         st = os.statvfs(self.path)
-        self.trace(
-            LOG_LOCAL + f"filesystem info: {st}"
-        )  # https://www.spinics.net/lists/linux-btrfs/msg103660.html
-        return st.f_bavail * st.f_bsize
+        if self.tracef:  # don't format the statvfs result for nothing
+            self.trace(
+                LOG_LOCAL + f"filesystem info: {st}"
+            )  # https://www.spinics.net/lists/linux-btrfs/msg103660.html
+        return st.f_bavail * st.f_frsize  # block counts are in f_frsize units
 
     def listdir(self):
-        return [d for d in os.listdir(self.path) if timef(d)]
+        if self.listing is None:
+            self.listing = self.listdir_path(self.path)
+        return self.listing
 
     def listdir_path(self, target_path):
-        return [d for d in os.listdir(target_path) if timef(d)]
+        # the entry types come with the directory listing, no stat needed as
+        # long as symlinks are not followed, snapshots are never links anyway
+        with os.scandir(target_path) as it:
+            return [
+                e.name
+                for e in it
+                if timestamp(e.name) is not None and e.is_dir(follow_symlinks=False)
+            ]
 
     def listremote_dir(self, receiver, receiver_path, ssh_port):
+        key = (receiver, receiver_path)
+        if key not in self.remote_listing:
+            self.remote_listing[key] = self.listremote_dir_path(
+                receiver, receiver_path, ssh_port
+            )
+        return self.remote_listing[key]
+
+    def listremote_dir_path(self, receiver, receiver_path, ssh_port):
         self.trace(
             LOG_REMOTE + f"list remote files host={receiver}, dir={receiver_path}"
         )
-        args = ["ssh", "-p", ssh_port, receiver, "ls -1 " + receiver_path]
-        return [
-            d for d in self.check_call(args, dry_safe=True).splitlines() if timef(d)
-        ]
+        # NUL separated paths, so odd directory names cannot split an entry,
+        # -print0 is also understood by the find of busybox and BSD
+        find = ["find", receiver_path, "-mindepth", "1", "-maxdepth", "1"]
+        find += ["-type", "d", "-print0"]
+        args = [*self.ssh_args(receiver, ssh_port), shlex.join(find)]
+        # the raw output is full of NULs, trace the names instead
+        output = self.check_call(args, dry_safe=True, trace_output=False)
+        names = (os.path.basename(d) for d in output.split("\0"))
+        dirs = [d for d in names if timestamp(d) is not None]
+        self.trace(LOG_OUTPUT + "%s", " ".join(dirs))
+        return dirs
+
+    def remote_remember(self, receiver, receiver_path, dir):
+        listing = self.remote_listing.get((receiver, receiver_path))
+        if listing is not None:
+            listing.append(dir)
+
+    def remote_forget(self, receiver, receiver_path, dirs):
+        listing = self.remote_listing.get((receiver, receiver_path))
+        if listing is not None:
+            dirs = set(dirs)
+            listing[:] = [d for d in listing if d not in dirs]
 
     def snap(self, path):
         # yt: changed to readonly snapshots
-        newdir = os.path.join(self.path, self.datestamp())
+        name = self.datestamp()
+        newdir = self.path_prefix + name
         self.trace(LOG_LOCAL + f"snapshotting path={path} to newdir={newdir}")
         args = ["sudo", "btrfs", "subvolume", "snapshot", "-r", path, newdir]
         self.check_call(args)
+        if self.listing is not None:
+            self.listing.append(name)
         self.sync(self.path)  # yt: make sure the new snap is on the disk
         self.trace(LOG_LOCAL + "done snapshotting")
         return newdir  # yt: return the latest snapshot
 
     @staticmethod
     def datestamp(secs=None):
-        return time.strftime(DATE_FORMAT, time.gmtime(secs))
+        return _datestamp(int(time.time() if secs is None else secs))
 
     def trace(self, *args, **kwargs):
         f = self.tracef
         if f:
             f(*args, **kwargs)
 
-    def send_single(self, snap, receiver, receiver_path, ssh_port, rate_limit):
+    def send_single(
+        self,
+        snap,
+        receiver,
+        receiver_path,
+        ssh_port,
+        rate_limit,
+        stream_buffer=None,
+        stream_compress=None,
+    ):
         self.trace(
             LOG_REMOTE
             + f"send single snapshot from {snap} to host {receiver} path={receiver_path}"
         )
-        args = [
-            f"sudo btrfs send -v {os.path.join(self.path, snap)}"
-            + f" | pv -brtfL {rate_limit} | "
-            + f"ssh -p {ssh_port} {receiver} 'sudo btrfs receive {receiver_path} '"
-        ]
-        # TODO: breakup the pipe stuff and do it without shell=True, currently it has problems with pipes :(
-        self.check_call(args, shell=True)
+        self.send_stream(
+            ["sudo", "btrfs", "send", "-v", self.path_prefix + snap],
+            ["sudo", "btrfs", "receive", receiver_path],
+            receiver,
+            ssh_port,
+            rate_limit,
+            stream_buffer,
+            stream_compress,
+        )
+        self.remote_remember(receiver, receiver_path, snap)
 
     def send_withparent(
-        self, parent_snap, snap, receiver, receiver_path, ssh_port, rate_limit
+        self,
+        parent_snap,
+        snap,
+        receiver,
+        receiver_path,
+        ssh_port,
+        rate_limit,
+        stream_buffer=None,
+        stream_compress=None,
     ):
         self.trace(
             LOG_REMOTE
             + f"send snapshot from {snap} with parent {parent_snap} to host {receiver} path={receiver_path}"
         )
-        args = [
-            f"sudo btrfs send -v -p {os.path.join(self.path, parent_snap)} {os.path.join(self.path, snap)}"
-            + f" | pv -brtfL {rate_limit} | "
-            + f"ssh -p {ssh_port} {receiver} 'sudo btrfs receive -v {receiver_path} '"
-        ]
-        self.check_call(args, shell=True)
+        self.send_stream(
+            [
+                "sudo",
+                "btrfs",
+                "send",
+                "-v",
+                "-p",
+                self.path_prefix + parent_snap,
+                self.path_prefix + snap,
+            ],
+            ["sudo", "btrfs", "receive", "-v", receiver_path],
+            receiver,
+            ssh_port,
+            rate_limit,
+            stream_buffer,
+            stream_compress,
+        )
+        self.remote_remember(receiver, receiver_path, snap)
         self.trace(LOG_REMOTE + "finished sending snapshot")
 
-    def link_current(self, receiver, receiver_path, snap, link_target, ssh_port):
+    def send_stream(
+        self,
+        send_args,
+        receive_args,
+        receiver,
+        ssh_port,
+        rate_limit,
+        stream_buffer,
+        stream_compress=None,
+    ):
+        # btrfs send [| zstd] [| pv] [| mbuffer] | ssh [mbuffer |] [unzstd |] receive
+        # mbuffer on both ends of the connection keeps btrfs send from
+        # stalling while ssh waits for the network and vice versa, pv comes
+        # after the compressor so --rate-limit applies to the bytes on the wire
+        commands = [send_args]
+        receive = shlex.join(receive_args)
+        if stream_compress is not None:
+            compress, decompress = STREAM_COMPRESSORS[stream_compress]
+            commands.append(compress)
+            receive = shlex.join(decompress) + " | " + receive
+        if self.tracef or rate_limit != "0":
+            # pv is only needed to limit the rate or for its statistics
+            commands.append(["pv", "-brtfL", rate_limit])
+        if stream_buffer is not None:
+            mbuffer = ["mbuffer", "-q", "-s", "128k", "-m", stream_buffer]
+            commands.append(mbuffer)
+            receive = shlex.join(mbuffer) + " | " + receive
+        commands.append([*self.ssh_args(receiver, ssh_port), receive])
+        self.check_pipe(*commands)
+
+    def async_link_current(self, receiver, receiver_path, snap, link_target, ssh_port):
         self.trace(
             LOG_REMOTE
             + f"linking current snapshot host={receiver} path={receiver_path} snap={snap} link={link_target}"
         )
-        args = [
-            "ssh",
-            "-p",
-            ssh_port,
-            receiver,
-            f"sudo ln -sfn '{os.path.join(receiver_path, snap)}' {link_target}",
-        ]
-        self.check_call(args)
-
-    def remote_unsnap(self, receiver, receiver_path, dir, ssh_port):
-        self.trace(
-            LOG_REMOTE
-            + f"delete snapshot {dir} from host={receiver} path={receiver_path}"
-        )
-        args = [
-            "ssh",
-            "-p",
-            ssh_port,
-            receiver,
-            f"sudo btrfs subvolume delete '{os.path.join(receiver_path, dir)}'",
-        ]
-        self.check_call(args)
-        self.trace(LOG_REMOTE + "deleted")
+        link = ["sudo", "ln", "-sfn", os.path.join(receiver_path, snap), link_target]
+        args = [*self.ssh_args(receiver, ssh_port), shlex.join(link)]
+        return self.async_check_call(args)
+
+    def remote_unsnap_many(self, receiver, receiver_path, dirs, ssh_port):
+        # one ssh round trip and one transaction commit per batch of snapshots
+        for batch in batches(dirs, DELETE_BATCH_SIZE):
+            self.trace(
+                LOG_REMOTE
+                + f"delete snapshots {' '.join(batch)} from host={receiver} path={receiver_path}"
+            )
+            paths = " ".join(
+                shlex.quote(os.path.join(receiver_path, dir)) for dir in batch
+            )
+            args = [
+                *self.ssh_args(receiver, ssh_port),
+                f"sudo btrfs subvolume delete --commit-after {paths}",
+            ]
+            self.check_call(args)
+            self.remote_forget(receiver, receiver_path, batch)
+            self.trace(LOG_REMOTE + f"deleted {len(batch)} snapshots")
 
     def sync_single(self, snap, target):
         self.trace(LOG_LOCAL + "sync single snapshot %s to %s", snap, target)
-        args = [
-            f"sudo btrfs send -v {os.path.join(self.path, snap)}"
-            + " | pv -brtf | "
-            + f"sudo btrfs receive -v {target}"
-        ]
-        self.check_call(args, shell=True)
+        self.sync_stream(
+            ["sudo", "btrfs", "send", "-v", self.path_prefix + snap],
+            ["sudo", "btrfs", "receive", "-v", target],
+        )
 
     def sync_withparent(self, parent_snap, snap, target_path):
         self.trace(
             LOG_LOCAL
             + f"send snapshot from {snap} with parent {parent_snap} to path={target_path}"
         )
-        args = [
-            f"sudo btrfs send -v -p {os.path.join(self.path, parent_snap)} {os.path.join(self.path, snap)}"
-            " | pv -brtf | "
-            f"sudo btrfs receive -v {target_path}"
-        ]
-        self.check_call(args, shell=True)
+        self.sync_stream(
+            [
+                "sudo",
+                "btrfs",
+                "send",
+                "-v",
+                "-p",
+                self.path_prefix + parent_snap,
+                self.path_prefix + snap,
+            ],
+            ["sudo", "btrfs", "receive", "-v", target_path],
+        )
+
+    def sync_stream(self, send_args, receive_args):
+        # btrfs send [| pv] | btrfs receive, pv only adds its statistics
+        if self.tracef:
+            self.check_pipe(send_args, ["pv", "-brtf"], receive_args)
+        else:
+            self.check_pipe(send_args, receive_args)
 
 
 # Allows to Simulate operations
 class DryOperations(Operations):
-    def __init__(self, path, trace=None):
-        Operations.__init__(self, path=path, trace=trace)
-        self.dirs = None
-
-    def check_call(self, args, shell=False, dry_safe=False):
+    def check_call(self, args, dry_safe=False, trace_output=True):
         cmd_str = " ".join(args)
         if dry_safe:
             self.trace(LOG_EXEC + "executing dry-safe command: " + cmd_str)
-            return Operations.check_call(self, args, shell, dry_safe)
+            return Operations.wait_call(
+                self, Operations.async_check_call(self, args), trace_output
+            )
         else:
             self.trace(LOG_EXEC + cmd_str)
 
-    # added to simulate also the deletion of snapshots
-    def listdir(self):
-        if self.dirs is None:
-            self.dirs = [d for d in os.listdir(self.path) if timef(d)]
-        return self.dirs
+    def async_check_call(self, args):
+        self.trace(LOG_EXEC + " ".join(args))
 
-    def unsnap(self, dir):
-        Operations.unsnap(self, dir)
-        self.dirs.remove(dir)
+    def wait_call(self, p, trace_output=True):
+        pass
+
+    def check_pipe(self, *commands):
+        self.trace(LOG_EXEC + " | ".join(" ".join(args) for args in commands))
+
+    @contextlib.contextmanager
+    def ssh_session(self, receiver, ssh_port):
+        self.trace(LOG_REMOTE + f"ssh master connection to host={receiver} not opened")
+        yield
 
 
 class FakeOperations(DryOperations):
@@ -443,11 +714,10 @@ class FakeOperations(DryOperations):
         self.dirs[self.datestamp()] = self.snap_space
         Operations.snap(self, path)
 
-    def unsnap(self, dir):
-        v = self.dirs[dir]
-        self.space += v
-        Operations.unsnap(self, dir)
-        del self.dirs[dir]
+    def unsnap_many(self, dirs):
+        Operations.unsnap_many(self, dirs)
+        for dir in dirs:
+            self.space += self.dirs.pop(dir)
 
     def listdir(self):
         self.trace(f"listdir() = {self.dirs.keys()}")
@@ -484,25 +754,26 @@ def cleandir(operations, targets):
     max_age = targets.max_age
     was_above_target_freespace = None
     was_above_target_backups = None
-    last_dirs = []
+    # snapshots selected for deletion, removed in one batch as long as
+    # there is no need to look at the filesystem in between
+    pending = []
+    # snapshots in the order of their value, only valid as long as all
+    # deleted snapshots were taken from it
+    by_value = None
 
     trace(
         LOG_LOCAL
         + f"Parameters for cleandir: keep_backups={keep_backups}, target_freespace={target_fsp}, "
         f"target_backups={target_backups}, max_age={max_age}, keep_latest={keep_latest}"
     )
-    next_del = None
+    dirs = sorted(operations.listdir())
 
     while True:
         do_del = None
-        dirs = sorted(operations.listdir())
         dirs_len = len(dirs)
         if dirs_len <= 0:
+            operations.unsnap_many(pending)
             raise Exception("No more directories to clean")
-        elif dirs == last_dirs:
-            raise Exception(f"Could not delete last snapshot: {next_del}")
-        else:
-            last_dirs = dirs
 
         # check at least keep this amount of backups
         if keep_backups is not None:
@@ -515,6 +786,9 @@ def cleandir(operations, targets):
                 break
 
         if target_fsp is not None:
+            # free space is only known after the deletions have been carried out
+            operations.unsnap_many(pending)
+            pending = []
             fsp = operations.freespace()
             # print "+++ ", fsp, target_fsp, fsp >= target_fsp
             if fsp >= target_fsp:
@@ -556,17 +830,32 @@ def cleandir(operations, targets):
         if keep_latest is not None and keep_latest:
             next_del = first(dirs)
         if next_del is None:
-            next_del = first(sorted_value(dirs))
+            if by_value is None:
+                by_value = sorted_value(dirs)
+            next_del = next(by_value, None)
         else:
+            by_value = None
             trace(LOG_LOCAL + "will delete backup: '%s'", operations.datestamp(max_age))
         if next_del is None:
             trace(LOG_LOCAL + "No more backups left")
             break
         else:
-            operations.unsnap(next_del)
-
-
-def transfer(operations, target_host, target_dir, link_dir, ssh_port, rate_limit):
+            pending.append(next_del)
+            dirs.remove(next_del)
+
+    operations.unsnap_many(pending)
+
+
+def transfer(
+    operations,
+    target_host,
+    target_dir,
+    link_dir,
+    ssh_port,
+    rate_limit,
+    stream_buffer=None,
+    stream_compress=None,
+):
     """ Transfer snapshots to remote host """
 
     trace = operations.trace
@@ -586,7 +875,13 @@ def transfer(operations, target_host, target_dir, link_dir, ssh_port, rate_limit
         # start transferring the oldest snapshot
         # by that snapbtrex will transfer all snapshots that have been created
         operations.send_single(
-            min(localsnaps), target_host, target_dir, ssh_port, rate_limit
+            min(localsnaps),
+            target_host,
+            target_dir,
+            ssh_port,
+            rate_limit,
+            stream_buffer,
+            stream_compress,
         )
         parents.add(min(localsnaps))
 
@@ -596,16 +891,43 @@ def transfer(operations, target_host, target_dir, link_dir, ssh_port, rate_limit
 
     trace(LOG_REMOTE + f"last possible parent = {max_parent}")
 
-    for s in sorted(localsnaps):
-        if s > max_parent:
-            trace(LOG_REMOTE + f"transfer: parent={parent} snap={s}")
-            operations.send_withparent(
-                parent, s, target_host, target_dir, ssh_port, rate_limit
-            )
-            if link_dir is not None:
-                operations.link_current(target_host, target_dir, s, link_dir, ssh_port)
-            # advance one step
-            parent = s
+    # the link is updated while the next snapshot is sent, but only one at a
+    # time so it ends up pointing at the latest one
+    linking = None
+    try:
+        for s in sorted(localsnaps):
+            if s > max_parent:
+                trace(LOG_REMOTE + f"transfer: parent={parent} snap={s}")
+                operations.send_withparent(
+                    parent,
+                    s,
+                    target_host,
+                    target_dir,
+                    ssh_port,
+                    rate_limit,
+                    stream_buffer,
+                    stream_compress,
+                )
+                if link_dir is not None:
+                    previous, linking = linking, None
+                    if previous is not None:
+                        operations.wait_call(previous)
+                    linking = operations.async_link_current(
+                        target_host, target_dir, s, link_dir, ssh_port
+                    )
+                # advance one step
+                parent = s
+    except Exception:
+        # the failed send is what gets reported, not a link that also failed
+        if linking is not None:
+            try:
+                operations.wait_call(linking)
+            except RuntimeError as e:
+                trace(LOG_REMOTE + f"ERROR while linking: {e}")
+        raise
+
+    if linking is not None:
+        operations.wait_call(linking)
 
 
 def remotecleandir(operations, target_host, target_dir, remote_keep, ssh_port):
@@ -633,12 +955,12 @@ def remotecleandir(operations, target_host, target_dir, remote_keep, ssh_port):
                 LOG_REMOTE
                 + f"about to remove {del_count} of out of {dirs_len} backups, keeping {remote_keep}"
             )
-            for del_dir in itertools.islice(delete_dirs, del_count):
-                if del_dir is None:
-                    trace(LOG_REMOTE + "No more backups left")
-                    break
-                else:
-                    operations.remote_unsnap(target_host, target_dir, del_dir, ssh_port)
+            operations.remote_unsnap_many(
+                target_host,
+                target_dir,
+                list(itertools.islice(delete_dirs, del_count)),
+                ssh_port,
+            )
 
 
 def sync_local(operations, sync_dir):
@@ -696,29 +1018,30 @@ def sync_cleandir(operations, target_dir, sync_keep):
                 LOG_LOCAL
                 + f"about to remove sync {del_count} of out of {dirs_len} synced backups, keeping {sync_keep}"
             )
-            for del_dir in itertools.islice(delete_dirs, del_count):
-                trace(LOG_LOCAL + "removing: ")
-                if del_dir is None:
-                    trace(LOG_LOCAL + "No more synced backups left")
-                    break
-                else:
-                    operations.unsnapx(os.path.join(target_dir, del_dir))
+            operations.unsnapx_many(
+                [
+                    os.path.join(target_dir, del_dir)
+                    for del_dir in itertools.islice(delete_dirs, del_count)
+                ]
+            )
 
 
 def log_trace(fmt, *args, **kwargs):
-    tt = time.strftime(DATE_FORMAT, time.gmtime(None)) + ": "
-    if args is not None:
+    tt = _datestamp(int(time.time())) + ": "
+    # only format if there is something to format, the plain messages
+    # may contain command output with a "%" in it
+    if args:
         print(tt + (fmt % args))
-    elif kwargs is not None:
+    elif kwargs:
         print(tt + (fmt % kwargs))
     else:
         print(tt + fmt)
 
 
 def default_trace(fmt, *args, **kwargs):
-    if args is not None:
+    if args:
         print(fmt % args)
-    elif kwargs is not None:
+    elif kwargs:
         print(fmt % kwargs)
     else:
         print(fmt)
@@ -729,24 +1052,27 @@ def null_trace(fmt, *args, **kwargs):
 
 
 def main(argv):
-    import argparse
-
     class UnitInt(int):
         format = ""
         mods = {}
+        pattern = None
 
         @staticmethod
-        def parse(cls, target_str):
-            import re
+        def compile(format, mods):
+            form = format % "|".join(x for x in mods.keys() if x is not None)
+            return re.compile(form, re.IGNORECASE)
 
-            form = cls.format % "|".join(x for x in cls.mods.keys() if x is not None)
-            m = re.match(form, target_str, re.IGNORECASE)
+        @staticmethod
+        def parse(cls, target_str):
+            m = cls.pattern.fullmatch(target_str)
             if m:
                 val, mod = m.groups()
                 result = cls.eval(int(val), mod)
                 return result
             else:
-                raise ValueError(f"Invalid value: {target_str}, expected: {form}")
+                raise argparse.ArgumentTypeError(
+                    f"Invalid value: {target_str}, expected: {cls.pattern.pattern}"
+                )
 
         def __init__(self, value):
             super().__init__(value)
@@ -765,14 +1091,15 @@ def main(argv):
 
     class Space(UnitInt):
         format = "([0-9]+)(%s)?"
-        mods = {None: 0, "K": 1, "M": 2, "G": 3, "T": 4}
+        mods = {None: 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+        pattern = UnitInt.compile(format, mods)
 
         @staticmethod
         def eval(val, mod):
             if mod is None:
                 return val
             else:
-                return val * 1024 ** Space.mods[mod.upper()]
+                return val * Space.mods[mod.upper()]
 
     class Age(UnitInt):
         format = "([0-9]+)(%s)?"
@@ -785,6 +1112,7 @@ def main(argv):
             "w": 7 * 24 * 60 * 60,
             "y": (52 * 7 + 1) * 24 * 60 * 60,  # year = 52 weeks + 1 or 2 days
         }
+        pattern = UnitInt.compile(format, mods)
 
         @staticmethod
         def eval(val, mod):
@@ -793,14 +1121,6 @@ def main(argv):
             else:
                 return max(0, time.time() - val * Age.mods[mod.lower()])
 
-    def parse_ageoffset_to_timestamp(age_str):
-        now = time.time()
-        age = int(age_str)
-        if age > now:
-            raise "Invalid value: %d, expected less than: %d" % (age, now)
-        else:
-            return float(now - age)
-
     parser = argparse.ArgumentParser(
         description="Keep btrfs snapshots for backup, optionally sync to snapshots locally or sends snapshots to "
         "remote systems via ssh. Visit https://github.com/yoshtec/snapbtrex for more insight."
@@ -952,6 +1272,23 @@ def main(argv):
         + "to denote kilobytes (*1024), megabytes, and so on.",
     )
 
+    transfer_group.add_argument(
+        "--stream-buffer",
+        metavar="SIZE",
+        dest="stream_buffer",
+        help="Buffer the transfer with mbuffer of SIZE memory (e.g. 256M) on "
+        + "both hosts, mbuffer has to be installed on the remote host as well.",
+    )
+
+    transfer_group.add_argument(
+        "--stream-compress",
+        choices=["none", *STREAM_COMPRESSORS],
+        default="none",
+        dest="stream_compress",
+        help="Compress the transfer, zstd or lz4 have to be installed on the "
+        + "remote host as well. (default: none)",
+    )
+
     sync_group = parser.add_argument_group(
         title="Sync Local",
         description="Transfer snapshots to another local (btrfs) filesystem.",
@@ -973,11 +1310,11 @@ def main(argv):
     )
 
     # safety net if no arguments are given call for usage
-    if len(sys.argv[1:]) == 0:
+    if len(argv[1:]) == 0:
         parser.print_usage()
         return 0
 
-    pa = parser.parse_args()
+    pa = parser.parse_args(argv[1:])
 
     if pa.verbose:
         if sys.stdout.isatty():
@@ -998,18 +1335,30 @@ def main(argv):
         return 1
 
     # test if pv is installed for needed actions
-    if (
-        not (pa.remote_host is None and pa.remote_dir is None)
-        or pa.sync_dir is not None
+    transferring = not (pa.remote_host is None and pa.remote_dir is None)
+    # pv is left out unless it has statistics to show or a rate to limit
+    if (transferring or pa.sync_dir is not None) and (
+        pa.verbose or pa.rate_limit != "0"
     ):
-        import shutil
-
         pv = shutil.which("pv")
         if pv is None:
             print("Error: Missing dependency 'pv' for transfer of snapshots")
             print("install e.g. via 'apt install pv'")
             return 1
 
+    if pa.stream_buffer is not None and shutil.which("mbuffer") is None:
+        trace(LOG_REMOTE + "mbuffer not found, transferring without --stream-buffer")
+        pa.stream_buffer = None
+
+    if pa.stream_compress == "none":
+        pa.stream_compress = None
+    elif shutil.which(pa.stream_compress) is None:
+        trace(
+            LOG_REMOTE
+            + f"{pa.stream_compress} not found, transferring without --stream-compress"
+        )
+        pa.stream_compress = None
+
     if pa.test:
         trace("## TEST ##")
         trace(
@@ -1050,22 +1399,25 @@ def main(argv):
     # 2. remote transfer: host and remote dir are needed
     if not (pa.remote_host is None and pa.remote_dir is None):
         try:
-            transfer(
-                operations,
-                pa.remote_host,
-                pa.remote_dir,
-                pa.remote_link,
-                pa.ssh_port,
-                pa.rate_limit,
-            )
-            if pa.remote_keep is not None:
-                remotecleandir(
+            with operations.ssh_session(pa.remote_host, pa.ssh_port):
+                transfer(
                     operations,
                     pa.remote_host,
                     pa.remote_dir,
-                    pa.remote_keep,
+                    pa.remote_link,
                     pa.ssh_port,
+                    pa.rate_limit,
+                    pa.stream_buffer,
+                    pa.stream_compress,
                 )
+                if pa.remote_keep is not None:
+                    remotecleandir(
+                        operations,
+                        pa.remote_host,
+                        pa.remote_dir,
+                        pa.remote_keep,
+                        pa.ssh_port,
+                    )
         except RuntimeError as e:
             trace(LOG_REMOTE + f"Error while transferring to remote host: {e}")
 